@@ -1,21 +1,43 @@
 from __future__ import annotations
 
-import json
+import asyncio
+import hashlib
 import os
+import re
 import textwrap
-from typing import Dict, List, Optional
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
 
 import duckdb
 import httpx
+import orjson
 import pandas as pd
+from cachetools import TTLCache
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel, Field
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response
+from pydantic import BaseModel, Field, ValidationError
 
+from pool import DuckPool
+from responses import frame_rows, orjson_response
+from sql_guard import cap_limit, parse_read_only
 
 WAREHOUSE = os.getenv("F1_WAREHOUSE", "/opt/data/warehouse/f1.duckdb")
 OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://ollama:11434")
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "llama3.2:3b")
 AI_MAX_ROWS = int(os.getenv("AI_MAX_ROWS", "200"))
+DUCKDB_POOL_SIZE = int(os.getenv("DUCKDB_POOL_SIZE", "4"))
+# Idle pooled handles are closed after this many seconds so dbt can take the write lock.
+DUCKDB_IDLE_TIMEOUT = float(os.getenv("DUCKDB_IDLE_TIMEOUT", "2"))
+SCHEMA_CACHE_TTL = float(os.getenv("SCHEMA_CACHE_TTL", "600"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "600"))
+# Extra samples fired concurrently when the first answer fails; 0 disables the fallback.
+AI_FALLBACK_CANDIDATES = int(os.getenv("AI_FALLBACK_CANDIDATES", "2"))
+# Keep in step with the Ollama server's OLLAMA_NUM_PARALLEL; more in-flight calls just queue there.
+OLLAMA_NUM_PARALLEL = int(os.getenv("OLLAMA_NUM_PARALLEL", "4"))
 
 OPENAI_STYLE_SYSTEM_PROMPT = """You are an analytics SQL copilot for a Formula 1 DuckDB warehouse.
 You must ONLY produce read-only DuckDB SQL queries against the provided schemas.
@@ -36,9 +58,16 @@ class AskRequest(BaseModel):
   session_code: Optional[str] = Field(None, description="Optional session hint such as R, Q, FP1")
 
 
+class AIPayload(BaseModel):
+  sql: Optional[str] = None
+  chart_type: Optional[str] = "table"
+  chart_fields: Optional[Dict[str, object]] = None
+  justification: Optional[str] = None
+
+
 class AskResponse(BaseModel):
   sql: str
-  rows: List[Dict[str, object]]
+  rows: List[List[object]]
   columns: List[str]
   row_count: int
   chart: Dict[str, object]
@@ -47,7 +76,36 @@ class AskResponse(BaseModel):
   gold_schema: str
 
 
-app = FastAPI(title="F1 AI Copilot", version="0.1.0")
+def _prepare_lookups(con: duckdb.DuckDBPyConnection) -> None:
+  # Planned once per pooled connection; resolve_schemas only EXECUTEs it.
+  con.execute(
+    "PREPARE schemas_present AS SELECT schema_name FROM information_schema.schemata "
+    "WHERE schema_name IN ('main_silver', 'silver', 'main_gold', 'gold')"
+  )
+
+
+pool = DuckPool(
+  WAREHOUSE, size=DUCKDB_POOL_SIZE, on_connect=_prepare_lookups, idle_timeout=DUCKDB_IDLE_TIMEOUT
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+  # One pooled client for the process: keep-alive connections to Ollama are reused across /ask calls.
+  app.state.http = httpx.AsyncClient(
+    base_url=OLLAMA_HOST,
+    http2=True,
+    timeout=httpx.Timeout(90.0, connect=10.0),
+    limits=httpx.Limits(max_keepalive_connections=40, max_connections=100, keepalive_expiry=30.0),
+  )
+  try:
+    yield
+  finally:
+    await app.state.http.aclose()
+    pool.close()
+
+
+app = FastAPI(title="F1 AI Copilot", version="0.1.0", lifespan=lifespan)
 
 
 @app.get("/healthz")
@@ -55,26 +113,46 @@ def healthcheck() -> Dict[str, str]:
   return {"status": "ok", "warehouse": WAREHOUSE}
 
 
-def _require_warehouse() -> None:
-  if not os.path.exists(WAREHOUSE):
-    raise HTTPException(status_code=500, detail=f"Warehouse not found at {WAREHOUSE}")
+def warehouse_mtime() -> float:
+  """The one stat per request: doubles as the existence check and keys every cache below."""
+  try:
+    return os.path.getmtime(WAREHOUSE)
+  except FileNotFoundError as exc:
+    raise HTTPException(status_code=500, detail=f"Warehouse not found at {WAREHOUSE}") from exc
 
 
-def resolve_schema(con: duckdb.DuckDBPyConnection, base_name: str) -> Optional[str]:
-  for schema in (f"main_{base_name}", base_name):
-    try:
-      exists = con.execute(
-        "SELECT 1 FROM information_schema.schemata WHERE schema_name = ? LIMIT 1",
-        [schema],
-      ).fetchone()
-      if exists:
-        return schema
-    except Exception:
-      continue
-  return None
+# Resolved (silver, gold) pair and the warehouse mtime it was resolved against.
+_schemas: Optional[Tuple[str, str]] = None
+_schemas_mtime = 0.0
+
+
+def resolve_schemas(con: duckdb.DuckDBPyConnection, mtime: float) -> Tuple[Optional[str], Optional[str]]:
+  """(silver, gold) schema names, preferring dbt's main_* prefix; one metadata query per dbt rebuild."""
+  global _schemas, _schemas_mtime
+  if _schemas is not None and mtime == _schemas_mtime:
+    return _schemas
+  present = {row[0] for row in con.execute("EXECUTE schemas_present").fetchall()}
+  silver_schema, gold_schema = (
+    next((schema for schema in (f"main_{base}", base) if schema in present), None)
+    for base in ("silver", "gold")
+  )
+  if silver_schema and gold_schema:
+    _schemas, _schemas_mtime = (silver_schema, gold_schema), mtime
+  return silver_schema, gold_schema
+
+
+# (warehouse, mtime, schema) -> (stored_at, overview); a dbt rebuild changes the mtime and misses.
+_schema_cache: Dict[Tuple[str, float, str], Tuple[float, str]] = {}
+# schema_overview runs in the threadpool; the stale sweep must not race another worker's insert.
+_schema_cache_lock = threading.Lock()
 
 
-def schema_overview(con: duckdb.DuckDBPyConnection, schema: str) -> str:
+def schema_overview(con: duckdb.DuckDBPyConnection, schema: str, mtime: float) -> str:
+  key = (WAREHOUSE, mtime, schema)
+  now = time.monotonic()
+  cached = _schema_cache.get(key)
+  if cached and now - cached[0] < SCHEMA_CACHE_TTL:
+    return cached[1]
   rows = con.execute(
     """
     SELECT table_name,
@@ -87,7 +165,12 @@ def schema_overview(con: duckdb.DuckDBPyConnection, schema: str) -> str:
     [schema],
   ).fetchall()
   parts = [f"{schema}.{table}({cols})" for table, cols in rows]
-  return "\n".join(parts)
+  overview = "\n".join(parts)
+  with _schema_cache_lock:
+    for stale in [k for k in _schema_cache if k[1] != key[1]]:
+      del _schema_cache[stale]
+    _schema_cache[key] = (now, overview)
+  return overview
 
 
 def build_prompt(question: str, schema_doc: str, request: AskRequest, silver_schema: str, gold_schema: str) -> str:
@@ -101,6 +184,9 @@ def build_prompt(question: str, schema_doc: str, request: AskRequest, silver_sch
 Important modeling guidance:
 - Use {gold_schema}.driver_session_summary for driver-level metrics (driver, team, best_lap_time, laps_total, personal_best_laps).
 - Use {gold_schema}.team_event_summary for team-level metrics (team_laps_on_track, team_pitstops, team_best_lap_time).
+- Use {gold_schema}.sessions for per-session facts (session_date, total_laps, unique_drivers, unique_teams).
+- Use {gold_schema}.session_pace for median lap time (ns) per lapnumber within a season/session_code.
+- Lap times are integer nanoseconds; ns_to_pretty(<ns column>) formats one as 'mm:ss.mmm'.
 - Use {silver_schema}.laps for raw lap telemetry (lap_time, lapnumber, driver, driver_number, team, pit_in_time, pit_out_time, sector1time..3time).
 Do NOT reference columns that are not listed in the schema dump below.
 Always prefer the gold tables when best_lap_time or aggregated insights are requested.
@@ -123,30 +209,81 @@ Respond strictly with JSON (no markdown) containing sql, chart_type, chart_field
   return textwrap.dedent(prompt).strip()
 
 
-def call_ollama(prompt: str) -> Dict[str, object]:
-  url = f"{OLLAMA_HOST.rstrip('/')}/api/chat"
+class _JsonObjectTracker:
+  """Incrementally tracks brace depth (ignoring braces inside strings) across streamed chunks."""
+
+  def __init__(self) -> None:
+    self.depth = 0
+    self.started = False
+    self.in_string = False
+    self.escaped = False
+
+  def feed(self, text: str) -> Optional[int]:
+    """Consume ``text``; once the first top-level JSON object closes, return the offset just past
+    its closing brace (anything after it in ``text`` is not part of the answer), else None."""
+    for i, ch in enumerate(text):
+      if self.in_string:
+        if self.escaped:
+          self.escaped = False
+        elif ch == "\\":
+          self.escaped = True
+        elif ch == '"':
+          self.in_string = False
+      elif ch == '"':
+        self.in_string = True
+      elif ch == "{":
+        self.depth += 1
+        self.started = True
+      elif ch == "}" and self.started:
+        self.depth -= 1
+        if self.depth == 0:
+          return i + 1
+    return None
+
+
+_ollama_slots = asyncio.Semaphore(OLLAMA_NUM_PARALLEL)
+
+
+async def call_ollama(http: httpx.AsyncClient, prompt: str, temperature: float = 0.1) -> Dict[str, object]:
   payload = {
     "model": OLLAMA_MODEL,
     "messages": [
       {"role": "system", "content": OPENAI_STYLE_SYSTEM_PROMPT},
       {"role": "user", "content": prompt},
     ],
-    "stream": False,
-    "options": {"temperature": 0.1},
+    "stream": True,
+    "options": {"temperature": temperature},
   }
+  parts: List[str] = []
+  tracker = _JsonObjectTracker()
   try:
-    with httpx.Client(timeout=90.0) as client:
-      response = client.post(url, json=payload)
+    async with _ollama_slots, http.stream("POST", "/api/chat", json=payload) as response:
+      if response.is_error:
+        await response.aread()
       response.raise_for_status()
-      data = response.json()
+      # Stop reading as soon as the JSON answer closes; leaving the block drops the
+      # connection so Ollama stops decoding any trailing tokens.
+      async for line in response.aiter_lines():
+        if not line:
+          continue
+        data = orjson.loads(line)
+        message = data.get("message", {})
+        piece = (message.get("content") if isinstance(message, dict) else data.get("response")) or ""
+        end = tracker.feed(piece)
+        if end is not None:
+          # drop trailing text in the same chunk (e.g. "}." or "}\n```") so the JSON parses
+          parts.append(piece[:end])
+          break
+        parts.append(piece)
+        if data.get("done"):
+          break
   except httpx.RequestError as exc:
     raise HTTPException(status_code=502, detail=f"Ollama connection failed: {exc}") from exc
   except httpx.HTTPStatusError as exc:
     raise HTTPException(status_code=502, detail=f"Ollama error: {exc.response.text}") from exc
 
-  message = data.get("message", {})
-  content = message.get("content") if isinstance(message, dict) else data.get("response")
-  if not content:
+  content = "".join(parts)
+  if not content.strip():
     raise HTTPException(status_code=500, detail="Ollama returned no content.")
   return parse_ai_response(content)
 
@@ -158,54 +295,135 @@ def parse_ai_response(content: str) -> Dict[str, object]:
     if "```" in cleaned:
       cleaned = cleaned.split("```", 1)[0]
   try:
-    parsed = json.loads(cleaned)
-  except json.JSONDecodeError as exc:
+    return AIPayload.model_validate_json(cleaned).model_dump()
+  except ValidationError as exc:
     raise HTTPException(status_code=500, detail=f"AI response was not valid JSON: {exc}") from exc
-  return parsed
 
 
-def ensure_safe_sql(sql: str) -> str:
+_WHITESPACE = re.compile(r"\s+")
+
+# question fingerprint -> (ai_payload, silver_schema, gold_schema); skips the Ollama round-trip on repeats.
+_answer_cache: TTLCache = TTLCache(maxsize=1024, ttl=ANSWER_CACHE_TTL)
+
+
+def normalize_question(question: str) -> str:
+  return _WHITESPACE.sub(" ", question.strip().lower()).rstrip("?!.;: ")
+
+
+def answer_cache_key(request: AskRequest, mtime: float) -> str:
+  # Including the warehouse mtime means a dbt rebuild (possibly with new columns) busts every entry.
+  raw = "|".join(
+    str(part)
+    for part in (
+      normalize_question(request.question),
+      request.season,
+      request.session_code,
+      mtime,
+    )
+  )
+  return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def ensure_safe_sql(sql: Optional[str]) -> str:
   if not sql:
     raise HTTPException(status_code=400, detail="AI did not provide SQL.")
   stmt = sql.strip().rstrip(";")
-  lower = stmt.lower()
-  forbidden = ("insert", "update", "delete", "drop", "alter", "create", "truncate")
-  if not lower.startswith("select"):
-    raise HTTPException(status_code=400, detail="Only SELECT statements are allowed.")
-  if any(keyword in lower for keyword in forbidden):
-    raise HTTPException(status_code=400, detail="Statement appears to modify data; rejecting.")
-  return f"SELECT * FROM ({stmt}) AS safe_view LIMIT {AI_MAX_ROWS}"
+  try:
+    tree = parse_read_only(stmt)
+  except ValueError as exc:
+    raise HTTPException(status_code=400, detail=str(exc)) from exc
+  return cap_limit(tree, AI_MAX_ROWS)
 
 
-def execute_sql(sql: str) -> pd.DataFrame:
-  con = duckdb.connect(WAREHOUSE, read_only=True)
-  try:
-    return con.execute(sql).df()
-  except duckdb.Error as exc:  # DuckDB binder/execution errors
-    raise HTTPException(status_code=400, detail=f"DuckDB failed to execute the AI-generated SQL: {exc}") from exc
-  finally:
-    con.close()
+def explain_sql(sql: str, mtime: float) -> None:
+  """Bind-check a statement without running it."""
+  with pool.acquire(mtime) as con:
+    try:
+      con.execute(f"EXPLAIN {sql}")
+    except duckdb.Error as exc:
+      raise HTTPException(status_code=400, detail=f"DuckDB rejected the AI-generated SQL: {exc}") from exc
+
+
+async def pick_fallback_candidate(
+  http: httpx.AsyncClient, prompt: str, first_error: HTTPException, mtime: float
+) -> Tuple[Dict[str, object], str]:
+  """Sample several answers concurrently and keep the first whose SQL passes the guard and binds."""
+  candidates = await asyncio.gather(
+    *(call_ollama(http, prompt, temperature=0.7) for _ in range(AI_FALLBACK_CANDIDATES)),
+    return_exceptions=True,
+  )
+  for candidate in candidates:
+    if isinstance(candidate, BaseException):
+      continue
+    try:
+      safe_sql = ensure_safe_sql(candidate.get("sql", ""))
+      await run_in_threadpool(explain_sql, safe_sql, mtime)
+    except HTTPException:
+      continue
+    return candidate, safe_sql
+  raise first_error
 
 
-@app.post("/ask", response_model=AskResponse)
-def ask(request: AskRequest) -> AskResponse:
-  _require_warehouse()
-  with duckdb.connect(WAREHOUSE, read_only=True) as con:
-    silver_schema = resolve_schema(con, "silver")
-    gold_schema = resolve_schema(con, "gold")
+# (sql, warehouse mtime) -> Arrow result; execute_sql runs in the threadpool, hence the lock.
+_result_cache: TTLCache = TTLCache(maxsize=256, ttl=RESULT_CACHE_TTL)
+_result_lock = threading.Lock()
+
+
+def execute_sql(sql: str, mtime: float) -> pd.DataFrame:
+  key = (sql, mtime)
+  with _result_lock:
+    table = _result_cache.get(key)
+  if table is None:
+    with pool.acquire(mtime) as con:
+      try:
+        table = con.execute(sql).fetch_arrow_table()
+      except duckdb.Error as exc:  # DuckDB binder/execution errors
+        raise HTTPException(status_code=400, detail=f"DuckDB failed to execute the AI-generated SQL: {exc}") from exc
+    with _result_lock:
+      _result_cache[key] = table
+  return table.to_pandas()
+
+
+def load_schema_context(mtime: float) -> Tuple[str, str, str]:
+  with pool.acquire(mtime) as con:
+    silver_schema, gold_schema = resolve_schemas(con, mtime)
     if not silver_schema or not gold_schema:
       raise HTTPException(status_code=400, detail="Silver/Gold schemas not found. Run dbt build first.")
     schema_doc = "\n".join(
       part for part in [
-        schema_overview(con, silver_schema),
-        schema_overview(con, gold_schema),
+        schema_overview(con, silver_schema, mtime),
+        schema_overview(con, gold_schema, mtime),
       ]
       if part
     )
-  prompt = build_prompt(request.question, schema_doc, request, silver_schema, gold_schema)
-  ai_payload = call_ollama(prompt)
-  safe_sql = ensure_safe_sql(ai_payload.get("sql", ""))
-  df = execute_sql(safe_sql)
+  return silver_schema, gold_schema, schema_doc
+
+
+@app.post("/ask", response_model=AskResponse)
+async def ask(request: AskRequest) -> Response:
+  mtime = warehouse_mtime()
+  cache_key = answer_cache_key(request, mtime)
+  cached = _answer_cache.get(cache_key)
+  if cached:
+    ai_payload, silver_schema, gold_schema = cached
+    safe_sql = ensure_safe_sql(ai_payload.get("sql", ""))
+    df = await run_in_threadpool(execute_sql, safe_sql, mtime)
+  else:
+    # DuckDB calls are blocking; keep them off the event loop so concurrent Ollama calls can overlap.
+    silver_schema, gold_schema, schema_doc = await run_in_threadpool(load_schema_context, mtime)
+    prompt = build_prompt(request.question, schema_doc, request, silver_schema, gold_schema)
+    try:
+      ai_payload = await call_ollama(app.state.http, prompt)
+      safe_sql = ensure_safe_sql(ai_payload.get("sql", ""))
+      df = await run_in_threadpool(execute_sql, safe_sql, mtime)
+    except HTTPException as exc:
+      # Unparseable JSON, rejected SQL or binder errors get another chance; Ollama outages do not.
+      if exc.status_code == 502 or AI_FALLBACK_CANDIDATES < 1:
+        raise
+      ai_payload, safe_sql = await pick_fallback_candidate(app.state.http, prompt, exc, mtime)
+      df = await run_in_threadpool(execute_sql, safe_sql, mtime)
+  # Only answers that validated and executed are worth replaying.
+  _answer_cache[cache_key] = (ai_payload, silver_schema, gold_schema)
 
   chart = {
     "type": ai_payload.get("chart_type", "table"),
@@ -213,13 +431,14 @@ def ask(request: AskRequest) -> AskResponse:
   }
   message = ai_payload.get("justification") or "Query executed successfully."
 
-  return AskResponse(
-    sql=safe_sql,
-    rows=df.to_dict(orient="records"),
-    columns=list(df.columns),
-    row_count=len(df),
-    chart=chart,
-    message=message,
-    silver_schema=silver_schema,
-    gold_schema=gold_schema,
-  )
+  # AskResponse documents the shape; rows are positional (aligned with columns) and encoded by orjson.
+  return orjson_response({
+    "sql": safe_sql,
+    "rows": frame_rows(df),
+    "columns": list(df.columns),
+    "row_count": len(df),
+    "chart": chart,
+    "message": message,
+    "silver_schema": silver_schema,
+    "gold_schema": gold_schema,
+  })
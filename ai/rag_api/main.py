@@ -1,55 +1,116 @@
-import os, re
+import asyncio, hashlib, os, re, threading, time
+from contextlib import asynccontextmanager
 from typing import Optional, Literal
-import duckdb, httpx, pandas as pd
+import duckdb, httpx, orjson, pandas as pd
+from cachetools import TTLCache
 from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 
+from pool import DuckPool
+from responses import frame_rows, orjson_response
+from sql_guard import cap_limit, parse_read_only
+
 WAREHOUSE = os.getenv("F1_WAREHOUSE", "/opt/data/warehouse/f1.duckdb")
 LLM_MODEL = os.getenv("LLM_MODEL", "llama3.2:3b")
 OLLAMA_URL = os.getenv("OLLAMA_URL", "http://ollama:11434")
-
-app = FastAPI(title="F1 AI Copilot", version="0.1.0")
+DUCKDB_POOL_SIZE = int(os.getenv("DUCKDB_POOL_SIZE", "4"))
+DUCKDB_IDLE_TIMEOUT = float(os.getenv("DUCKDB_IDLE_TIMEOUT", "2"))
+SCHEMA_CACHE_TTL = float(os.getenv("SCHEMA_CACHE_TTL", "600"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "600"))
+
+# compiled once at import instead of on every /ask
+_SQL_FENCE = re.compile(r"```sql\s*(.*?)```", re.S|re.I)
+_WHITESPACE = re.compile(r"\s+")
+_SILVER_PREFIX = re.compile(r"\bsilver\.")
+_GOLD_PREFIX = re.compile(r"\bgold\.")
+_CHART_TIME_KEYS = frozenset({"lapnumber","round","season"})
 
 # ---------- DB helpers ----------
-def connect_ro():
-    # DuckDB needs write access for temp ops; we still enforce SELECT-only at SQL level
-    return duckdb.connect(WAREHOUSE, read_only=False)
-
-def detect_schema_prefix(con: duckdb.DuckDBPyConnection) -> tuple[str,str]:
+# read-only connections checked out per request and closed when idle, so dbt can take the write lock;
+# SELECT-only is still enforced at SQL level
+pool = DuckPool(WAREHOUSE, size=DUCKDB_POOL_SIZE, idle_timeout=DUCKDB_IDLE_TIMEOUT)
+
+# one metadata query answers both lookups; result cached until the warehouse mtime changes
+_SCHEMA_PROBE = """
+  select table_schema from information_schema.tables
+  where (table_name = 'laps' and table_schema in ('main_silver', 'silver'))
+     or (table_name = 'driver_session_summary' and table_schema in ('main_gold', 'gold'))
+"""
+_schema_pair: dict[float, tuple[str,str]] = {}
+
+def detect_schema_prefix(con: duckdb.DuckDBPyConnection, mtime: float) -> tuple[str,str]:
+    if mtime in _schema_pair:
+        return _schema_pair[mtime]
+    present = {row[0] for row in con.execute(_SCHEMA_PROBE).fetchall()}
     for s,g in (("main_silver","main_gold"), ("silver","gold")):
-        try:
-            con.execute(f"SELECT 1 FROM information_schema.tables WHERE table_schema='{s}' AND table_name='laps' LIMIT 1").fetchone()
-            con.execute(f"SELECT 1 FROM information_schema.tables WHERE table_schema='{g}' AND table_name='driver_session_summary' LIMIT 1").fetchone()
+        if s in present and g in present:
+            _schema_pair.clear()
+            _schema_pair[mtime] = (s, g)
             return s,g
-        except Exception:
-            pass
     return "main_silver","main_gold"
 
-def schema_snapshot(con: duckdb.DuckDBPyConnection) -> str:
-    s,g = detect_schema_prefix(con)
-    q = f"""
-      select table_schema, table_name, column_name, data_type
+# (warehouse, mtime) -> (stored_at, snapshot); dbt rebuilds bump the mtime and invalidate it
+_schema_cache: dict[tuple[str,float], tuple[float,str]] = {}
+
+def schema_snapshot(con: duckdb.DuckDBPyConnection, mtime: float) -> str:
+    key = (WAREHOUSE, mtime)
+    now = time.monotonic()
+    cached = _schema_cache.get(key)
+    if cached and now - cached[0] < SCHEMA_CACHE_TTL:
+        return cached[1]
+    s,g = detect_schema_prefix(con, mtime)
+    # let DuckDB build each table's column list; no pandas on this path
+    rows = con.execute("""
+      select table_schema, table_name,
+             string_agg(column_name || ':' || data_type, ', ' order by ordinal_position) as cols
       from information_schema.columns
-      where table_schema in ('{s}','{g}')
-      order by table_schema, table_name, ordinal_position
-    """
-    df = con.sql(q).df()
-    lines = []
-    for (sch, tbl), grp in df.groupby(["table_schema","table_name"]):
-        cols = ", ".join(f"{r['column_name']}:{r['data_type']}" for _,r in grp.iterrows())
-        lines.append(f"{sch}.{tbl}({cols})")
-    return "\n".join(lines)
+      where table_schema in (?, ?)
+      group by 1, 2
+      order by 1, 2
+    """, [s, g]).fetchall()
+    snapshot = "\n".join(f"{sch}.{tbl}({c})" for sch, tbl, c in rows)
+    _schema_cache.clear()
+    _schema_cache[key] = (now, snapshot)
+    return snapshot
+
+def ping_db() -> None:
+    with pool.acquire() as con:
+        con.sql("select 1").fetchone()
+
+def load_snapshot(mtime: float) -> tuple[str,str,str]:
+    with pool.acquire(mtime) as con:
+        s,g = detect_schema_prefix(con, mtime)
+        return s, g, schema_snapshot(con, mtime)
+
+# (sql, warehouse mtime) -> Arrow result, so repeated SQL skips DuckDB entirely
+_result_cache: TTLCache = TTLCache(maxsize=256, ttl=RESULT_CACHE_TTL)
+_result_lock = threading.Lock()
+
+def run_sql(sql: str, mtime: float) -> pd.DataFrame:
+    key = (sql, mtime)
+    with _result_lock:
+        table = _result_cache.get(key)
+    if table is None:
+        with pool.acquire(mtime) as con:
+            table = con.sql(sql).fetch_arrow_table()
+        with _result_lock:
+            _result_cache[key] = table
+    return table.to_pandas()
 
 # ---------- LLM helpers ----------
-def pull_model_if_needed():
+async def pull_model_if_needed(app: FastAPI) -> None:
+    # runs as a background task so a first-boot pull (minutes) never blocks startup
     try:
-        with httpx.Client(timeout=None) as cli:
-            tags = cli.get(f"{OLLAMA_URL}/api/tags").json()
-            names = [m.get("name","") for m in tags.get("models",[])]
-            if LLM_MODEL not in names:
-                cli.post(f"{OLLAMA_URL}/api/pull", json={"name": LLM_MODEL})
+        tags = orjson.loads((await app.state.http.get("/api/tags")).content)
+        names = [m.get("name","") for m in tags.get("models",[])]
+        if LLM_MODEL not in names:
+            r = await app.state.http.post("/api/pull", json={"name": LLM_MODEL, "stream": False}, timeout=None)
+            r.raise_for_status()
+        app.state.model_ready = True
     except Exception:
-        # best-effort; health will show if it's missing
+        # best-effort; /health reports model_ready=False until a pull succeeds
         pass
 
 def make_system_prompt(schema_text: str, limit_rows: int = 200) -> str:
@@ -68,28 +129,47 @@ SCHEMA:
 {schema_text}
 """.strip()
 
-def call_ollama(prompt: str) -> str:
-    with httpx.Client(timeout=None) as cli:
-        r = cli.post(f"{OLLAMA_URL}/api/generate",
-                     json={"model": LLM_MODEL, "prompt": prompt, "stream": False})
+async def call_ollama(http: httpx.AsyncClient, prompt: str) -> str:
+    # stream tokens and hang up once the ```sql fence closes; the rest is just commentary
+    parts: list[str] = []
+    async with http.stream("POST", "/api/generate",
+                           json={"model": LLM_MODEL, "prompt": prompt, "stream": True}) as r:
         if r.status_code != 200:
+            await r.aread()
             raise HTTPException(500, f"Ollama error: {r.text}")
-        return r.json().get("response","")
-
-def extract_sql(text: str) -> str:
-    m = re.search(r"```sql\s*(.*?)```", text, flags=re.S|re.I)
+        async for line in r.aiter_lines():
+            if not line:
+                continue
+            chunk = orjson.loads(line)
+            piece = chunk.get("response", "")
+            parts.append(piece)
+            if chunk.get("done"):
+                break
+            # the fence can only close on a piece carrying a backtick; don't rescan the buffer otherwise
+            if "`" in piece and _SQL_FENCE.search("".join(parts)):
+                break
+    return "".join(parts)
+
+# normalized question + limit + warehouse mtime -> final SQL; repeats skip the LLM entirely
+_sql_by_question: TTLCache = TTLCache(maxsize=1024, ttl=ANSWER_CACHE_TTL)
+
+def question_key(question: str, limit: int, mtime: float) -> str:
+    norm = _WHITESPACE.sub(" ", question.strip().lower()).rstrip("?!.;: ")
+    raw = f"{norm}|{limit}|{mtime}"
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+def extract_sql(text: str, limit: int = 200) -> str:
+    m = _SQL_FENCE.search(text)
     sql = (m.group(1) if m else text).strip().rstrip(";")
-    if re.search(r"\b(insert|update|delete|drop|alter|create)\b", sql, flags=re.I):
-        raise HTTPException(400, "Only SELECT queries are allowed.")
-    if not re.match(r"^\s*select\b", sql, flags=re.I):
-        raise HTTPException(400, "Model did not return a SELECT query.")
-    if not re.search(r"\blimit\b", sql, flags=re.I):
-        sql += " LIMIT 200"
-    return sql
+    try:
+        tree = parse_read_only(sql)
+    except ValueError as e:
+        raise HTTPException(400, f"Model did not return a read-only SELECT query: {e}")
+    return cap_limit(tree, limit)
 
 def suggest_chart(cols: list[str], df: pd.DataFrame) -> str:
     numeric = df.select_dtypes(include=["number"]).columns.tolist()
-    if len(numeric) >= 1 and any(k in [c.lower() for c in cols] for k in ["lapnumber","round","season"]):
+    if len(numeric) >= 1 and not _CHART_TIME_KEYS.isdisjoint(c.lower() for c in cols):
         return "line"
     if len(numeric) >= 1 and df.shape[0] <= 25:
         return "bar"
@@ -106,45 +186,70 @@ class AskOut(BaseModel):
     rows: list[list]
     columns: list[str]
 
-# ---------- Routes ----------
-@app.on_event("startup")
-def _startup():
-    pull_model_if_needed()
+# ---------- App ----------
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # shared keep-alive client for every Ollama call made by this process
+    app.state.http = httpx.AsyncClient(
+        base_url=OLLAMA_URL,
+        http2=True,
+        timeout=httpx.Timeout(90.0, connect=10.0),
+        limits=httpx.Limits(max_keepalive_connections=40, max_connections=100, keepalive_expiry=30.0),
+    )
+    app.state.model_ready = False
+    pull_task = asyncio.create_task(pull_model_if_needed(app))
+    try:
+        yield
+    finally:
+        pull_task.cancel()
+        await app.state.http.aclose()
+        pool.close()
+
+app = FastAPI(title="F1 AI Copilot", version="0.1.0", lifespan=lifespan)
 
+# ---------- Routes ----------
 @app.get("/")
 def root():
     return {"ok": True, "service": "f1-ai", "model": LLM_MODEL, "warehouse": WAREHOUSE}
 
 @app.get("/health")
-def health():
+async def health():
     ok_db = os.path.exists(WAREHOUSE)
     try:
-        with connect_ro() as con:
-            con.sql("select 1").fetchone()
+        await run_in_threadpool(ping_db)
         ok_sql = True
     except Exception:
         ok_sql = False
     ok_ollama = False
     try:
-        with httpx.Client(timeout=30) as cli:
-            r = cli.get(f"{OLLAMA_URL}/api/tags")
-            ok_ollama = r.status_code == 200
+        r = await app.state.http.get("/api/tags", timeout=30)
+        ok_ollama = r.status_code == 200
     except Exception:
         pass
-    return {"warehouse": WAREHOUSE, "db_ok": ok_db and ok_sql, "ollama_ok": ok_ollama, "model": LLM_MODEL}
+    return {"warehouse": WAREHOUSE, "db_ok": ok_db and ok_sql, "ollama_ok": ok_ollama,
+            "model": LLM_MODEL, "model_ready": app.state.model_ready}
 
 @app.post("/ask", response_model=AskOut)
-def ask(payload: AskIn):
-    with connect_ro() as con:
-        s,g = detect_schema_prefix(con)
-        snapshot = schema_snapshot(con)
+async def ask(payload: AskIn):
+    # DuckDB work runs in the threadpool so the event loop stays free while Ollama generates.
+    # One stat per request: every cache key below and the pool agree on the same warehouse version.
+    try:
+        mtime = os.path.getmtime(WAREHOUSE)
+    except FileNotFoundError:
+        raise HTTPException(500, f"Warehouse not found at {WAREHOUSE}")
+    key = question_key(payload.question, payload.limit or 200, mtime)
+    sql = _sql_by_question.get(key)
+    if sql is None:
+        s,g,snapshot = await run_in_threadpool(load_snapshot, mtime)
         sys = make_system_prompt(snapshot, limit_rows=payload.limit or 200)
         user = f"Question: {payload.question}\nUse schemas actually present: silver={s}, gold={g}."
-        raw = call_ollama(sys + "\n\n" + user)
-        sql = extract_sql(raw)
+        raw = await call_ollama(app.state.http, sys + "\n\n" + user)
+        sql = extract_sql(raw, payload.limit or 200)
         # rewrite schema names if the model returned plain 'silver.' / 'gold.'
-        sql = re.sub(r"\bsilver\.", f"{s}.", sql)
-        sql = re.sub(r"\bgold\.",   f"{g}.", sql)
-        df = con.sql(sql).df()
-        return AskOut(sql=sql, chart=suggest_chart(df.columns.tolist(), df),
-                      rows=df.values.tolist(), columns=df.columns.tolist())
+        sql = _SILVER_PREFIX.sub(f"{s}.", sql)
+        sql = _GOLD_PREFIX.sub(f"{g}.", sql)
+    df = await run_in_threadpool(run_sql, sql, mtime)
+    _sql_by_question[key] = sql
+    # AskOut documents the shape; orjson encodes it without per-row model validation
+    return orjson_response({"sql": sql, "chart": suggest_chart(df.columns.tolist(), df),
+                            "rows": frame_rows(df), "columns": df.columns.tolist()})
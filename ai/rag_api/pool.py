@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator, Optional, Tuple
+
+import duckdb
+
+# An idle slot: the open connection and when it was last handed back; None means closed.
+_Slot = Optional[Tuple[duckdb.DuckDBPyConnection, float]]
+
+
+class DuckPool:
+  """Bounded pool of read-only DuckDB connections to the warehouse file.
+
+  Any open handle, read-only included, holds DuckDB's file lock, and a writer in another
+  process (``dbt build``) fails with "Conflicting lock is held" until every handle in this
+  process is closed. Slots are therefore opened lazily and closed again once they have sat
+  idle for ``idle_timeout`` seconds, so dbt can run whenever the service is quiet; a timeout
+  of 0 closes each connection as soon as it is returned, like one connection per request.
+  If the file's mtime changes while slots are open (the file was swapped rather than written
+  in place) every slot is drained and closed before reconnecting, because DuckDB shares one
+  database instance per path inside a process and would otherwise keep serving the old file.
+  ``on_connect`` runs once per new connection (e.g. to PREPARE statements).
+  """
+
+  def __init__(
+    self,
+    path: str,
+    size: int = 4,
+    on_connect: Optional[Callable[[duckdb.DuckDBPyConnection], None]] = None,
+    idle_timeout: float = 2.0,
+  ) -> None:
+    self.path = path
+    self.size = size
+    self.on_connect = on_connect
+    self.idle_timeout = idle_timeout
+    self._idle: "queue.Queue[_Slot]" = queue.Queue(maxsize=size)
+    self._refresh_lock = threading.Lock()
+    self._mtime: Optional[float] = None
+    self._closed = threading.Event()
+    for _ in range(size):
+      self._idle.put(None)
+    if idle_timeout > 0:
+      threading.Thread(target=self._reap, name="duckpool-reaper", daemon=True).start()
+
+  def _reap(self) -> None:
+    while not self._closed.wait(self.idle_timeout / 2):
+      # Only slots that are idle right now are visited; checked-out ones come back stamped.
+      for _ in range(self._idle.qsize()):
+        try:
+          slot = self._idle.get_nowait()
+        except queue.Empty:
+          break
+        if slot is not None and time.monotonic() - slot[1] >= self.idle_timeout:
+          slot[0].close()
+          slot = None
+        self._idle.put(slot)
+
+  def _refresh(self, mtime: float) -> None:
+    with self._refresh_lock:
+      if self._mtime == mtime:
+        return
+      # Take every slot (waits for in-flight queries) so no stale handle survives.
+      slots = [self._idle.get() for _ in range(self.size)]
+      for slot in slots:
+        if slot is not None:
+          slot[0].close()
+      self._mtime = mtime
+      for _ in range(self.size):
+        self._idle.put(None)
+
+  @contextmanager
+  def acquire(self, mtime: Optional[float] = None) -> Iterator[duckdb.DuckDBPyConnection]:
+    """Check out a connection. Pass the warehouse ``mtime`` when the caller already has it, to
+    avoid another stat."""
+    if mtime is None:
+      mtime = os.path.getmtime(self.path)
+    if mtime != self._mtime:
+      self._refresh(mtime)
+    slot = self._idle.get()
+    con: Optional[duckdb.DuckDBPyConnection] = None
+    try:
+      if slot is None:
+        con = duckdb.connect(self.path, read_only=True)
+        if self.on_connect is not None:
+          self.on_connect(con)
+      else:
+        con = slot[0]
+      yield con
+    finally:
+      if con is not None and self.idle_timeout <= 0:
+        con.close()
+        con = None
+      self._idle.put((con, time.monotonic()) if con is not None else None)
+
+  def close(self) -> None:
+    self._closed.set()
+    for _ in range(self.size):
+      slot = self._idle.get()
+      if slot is not None:
+        slot[0].close()
+      self._idle.put(None)
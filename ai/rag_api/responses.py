@@ -0,0 +1,35 @@
+from __future__ import annotations
+
+from decimal import Decimal
+from typing import Dict
+
+import orjson
+import pandas as pd
+from fastapi.responses import Response
+
+
+def _json_default(obj: object) -> object:
+  if obj is pd.NaT or obj is pd.NA:
+    return None
+  if isinstance(obj, pd.Timestamp):
+    return obj.isoformat()
+  if isinstance(obj, Decimal):
+    # keep DECIMAL columns numeric so charts treat them as values, not categories
+    return float(obj)
+  return str(obj)
+
+
+def orjson_response(body: Dict[str, object]) -> Response:
+  """Serialize a result payload with orjson, bypassing FastAPI's per-object response encoding."""
+  content = orjson.dumps(body, default=_json_default, option=orjson.OPT_SERIALIZE_NUMPY)
+  return Response(content=content, media_type="application/json")
+
+
+def frame_rows(df: pd.DataFrame) -> list:
+  """Rows as positional lists; pair with ``df.columns`` instead of repeating keys per row.
+
+  Built column by column so each keeps its own dtype (ints stay ints in an all-numeric frame,
+  where ``df.to_numpy()`` would upcast everything to float).
+  """
+  columns = [df.iloc[:, i].tolist() for i in range(df.shape[1])]
+  return [list(row) for row in zip(*columns)]
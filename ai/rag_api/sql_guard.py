@@ -0,0 +1,58 @@
+from __future__ import annotations
+
+import sqlglot
+from sqlglot import exp
+from sqlglot.errors import ParseError
+
+# Statement types that write data or change the session (ATTACH, SET, PRAGMA, ...). This does not
+# stop reads such as read_csv(...) or getenv(...); the read-only connection is what limits those to
+# reading. Looked up by name because not every sqlglot release ships all of them.
+_FORBIDDEN_NODES = tuple(
+  getattr(exp, name)
+  for name in (
+    "Insert", "Update", "Delete", "Merge", "Drop", "Alter", "Create", "TruncateTable",
+    "Copy", "Attach", "Detach", "Pragma", "Set", "Use", "Command",
+  )
+  if hasattr(exp, name)
+)
+
+
+def parse_read_only(sql: str) -> exp.Query:
+  """Parse ``sql`` as exactly one read-only DuckDB query, raising ValueError otherwise.
+
+  The whole tree is walked once, so identifiers such as ``inserted_at`` no longer trip the check
+  and CTE/UNION queries are accepted.
+  """
+  try:
+    statements = [stmt for stmt in sqlglot.parse(sql, read="duckdb") if stmt is not None]
+  except ParseError as exc:
+    raise ValueError(f"Could not parse SQL: {exc}") from exc
+  if len(statements) != 1:
+    raise ValueError("Exactly one SQL statement is allowed.")
+  tree = statements[0]
+  if not isinstance(tree, exp.Query):
+    raise ValueError("Only SELECT statements are allowed.")
+  if any(isinstance(node, _FORBIDDEN_NODES) for node in tree.walk()):
+    raise ValueError("Statement appears to modify data; rejecting.")
+  return tree
+
+
+def cap_limit(tree: exp.Query, max_rows: int) -> str:
+  """Render ``tree`` with its outermost LIMIT capped at ``max_rows``.
+
+  Rewriting the statement's own LIMIT (instead of wrapping it in ``SELECT * ... LIMIT``) keeps the
+  limit where DuckDB can push it down into the scan.
+  """
+  limit = tree.args.get("limit")
+  if isinstance(limit, exp.Fetch):
+    # FETCH FIRST n ROWS ONLY keeps its count under "count"; a bare FETCH FIRST ROW ONLY means 1.
+    value = limit.args.get("count") or exp.Literal.number(1)
+  else:
+    value = limit.expression if limit is not None else None
+  # Only a plain row count is kept; ``PERCENT`` / ``WITH TIES`` parse as the same integer literal
+  # plus limit_options, so those get replaced outright.
+  options = limit.args.get("limit_options") if limit is not None else None
+  plain = limit is not None and not (options and (options.args.get("percent") or options.args.get("with_ties")))
+  if not (plain and isinstance(value, exp.Literal) and value.is_int and int(value.this) <= max_rows):
+    tree.set("limit", exp.Limit(expression=exp.Literal.number(max_rows)))
+  return tree.sql(dialect="duckdb")
@@ -0,0 +1,38 @@
+import subprocess
+import sys
+import time
+
+import duckdb
+
+from pool import DuckPool
+
+
+def _write_from_other_process(path: str) -> subprocess.CompletedProcess:
+  code = f"import duckdb; duckdb.connect({path!r}).execute('CREATE OR REPLACE TABLE t AS SELECT 2 AS x')"
+  return subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+
+
+def test_idle_slots_release_the_file_lock(tmp_path):
+  path = str(tmp_path / "wh.duckdb")
+  duckdb.connect(path).execute("CREATE TABLE t AS SELECT 1 AS x").close()
+  pool = DuckPool(path, size=2, idle_timeout=0.2)
+  try:
+    with pool.acquire() as con:
+      assert con.execute("SELECT x FROM t").fetchone() == (1,)
+      assert _write_from_other_process(path).returncode != 0
+    time.sleep(0.6)
+    assert _write_from_other_process(path).returncode == 0
+    with pool.acquire() as con:
+      assert con.execute("SELECT x FROM t").fetchone() == (2,)
+  finally:
+    pool.close()
+
+
+def test_zero_timeout_closes_on_release(tmp_path):
+  path = str(tmp_path / "wh.duckdb")
+  duckdb.connect(path).execute("CREATE TABLE t AS SELECT 1 AS x").close()
+  pool = DuckPool(path, size=1, idle_timeout=0)
+  with pool.acquire() as con:
+    con.execute("SELECT 1")
+  assert _write_from_other_process(path).returncode == 0
+  pool.close()
@@ -0,0 +1,18 @@
+from decimal import Decimal
+
+import orjson
+import pandas as pd
+
+from responses import frame_rows, orjson_response
+
+
+def test_frame_rows_keeps_int_columns_in_numeric_frame():
+  df = pd.DataFrame({"season": [2024], "driver_number": [44], "best_lap_seconds": [92.345]})
+  rows = orjson.loads(orjson_response({"rows": frame_rows(df)}).body)["rows"]
+  assert rows == [[2024, 44, 92.345]]
+  assert isinstance(rows[0][0], int)
+
+
+def test_decimal_serializes_as_number():
+  df = pd.DataFrame({"avg_pitstops": [Decimal("1.50")]})
+  assert orjson.loads(orjson_response({"rows": frame_rows(df)}).body)["rows"] == [[1.5]]
@@ -0,0 +1,54 @@
+import pytest
+import sqlglot
+
+from sql_guard import cap_limit, parse_read_only
+
+
+def _limit(sql: str) -> str:
+  return sqlglot.parse_one(sql, read="duckdb").args["limit"].sql(dialect="duckdb")
+
+
+def test_plain_limit_under_cap_is_kept():
+  assert _limit(cap_limit(parse_read_only("SELECT * FROM laps LIMIT 10"), 200)) == "LIMIT 10"
+
+
+def test_missing_limit_is_added():
+  assert _limit(cap_limit(parse_read_only("SELECT * FROM laps"), 200)) == "LIMIT 200"
+
+
+def test_oversize_limit_is_capped():
+  assert _limit(cap_limit(parse_read_only("SELECT * FROM laps LIMIT 5000"), 200)) == "LIMIT 200"
+
+
+def test_percent_limit_is_replaced():
+  capped = cap_limit(parse_read_only("SELECT * FROM laps LIMIT 10 PERCENT"), 200)
+  assert "PERCENT" not in capped.upper()
+  assert _limit(capped) == "LIMIT 200"
+
+
+def test_fetch_first_under_cap_is_kept():
+  assert _limit(cap_limit(parse_read_only("SELECT * FROM laps FETCH FIRST 10 ROWS ONLY"), 200)) == "LIMIT 10"
+
+
+def test_fetch_first_over_cap_is_capped():
+  assert _limit(cap_limit(parse_read_only("SELECT * FROM laps FETCH FIRST 5000 ROWS ONLY"), 200)) == "LIMIT 200"
+
+
+def test_fetch_first_with_ties_is_replaced():
+  capped = cap_limit(parse_read_only("SELECT * FROM laps ORDER BY lap FETCH FIRST 10 ROWS WITH TIES"), 200)
+  assert _limit(capped) == "LIMIT 200"
+
+
+def test_union_limit_applies_to_whole_query():
+  capped = cap_limit(parse_read_only("SELECT 1 AS x UNION ALL SELECT 2 LIMIT 5000"), 200)
+  assert _limit(capped) == "LIMIT 200"
+
+
+def test_cte_inner_limit_does_not_count_as_outer_cap():
+  capped = cap_limit(parse_read_only("WITH c AS (SELECT * FROM laps LIMIT 5) SELECT * FROM c"), 200)
+  assert _limit(capped) == "LIMIT 200"
+
+
+def test_write_statement_is_rejected():
+  with pytest.raises(ValueError):
+    parse_read_only("DELETE FROM laps")
@@ -1,71 +1,232 @@
+import numbers
 import os
+import queue
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Optional
 
 import duckdb
+import httpx
 import pandas as pd
 import plotly.express as px
-import requests
+import plotly.graph_objects as go
+import pyarrow as pa
 import streamlit as st
 
 WAREHOUSE = os.getenv("F1_WAREHOUSE", "/opt/data/warehouse/f1.duckdb")
 AI_SERVICE_URL = os.getenv("AI_SERVICE_URL", "http://ai:8000").rstrip("/")
+BRONZE = os.getenv("F1_BRONZE", "/opt/data/bronze")
+# Opt-in: scan the Hive-partitioned bronze laps instead of the silver table, so the
+# season/session filters prune whole partition directories before any file is opened.
+LAPS_FROM_BRONZE = os.getenv("F1_LAPS_FROM_BRONZE", "0").lower() in ("1", "true", "yes")
+PACE_MAX_POINTS = 2000
+DUCKDB_THREADS = int(os.getenv("DUCKDB_THREADS", str(os.cpu_count() or 1)))
+DUCKDB_MEMORY_LIMIT = os.getenv("DUCKDB_MEMORY_LIMIT", "4GB")
+DUCKDB_POOL_SIZE = int(os.getenv("DUCKDB_POOL_SIZE", "4"))
 
 
 @st.cache_resource(show_spinner=False)
-def get_con():
+def _open_connections() -> list:
+    # survives reruns, so get_con can close the handle it opened for the previous mtime
+    return []
+
+
+@st.cache_resource(show_spinner=False, max_entries=1)
+def get_con(mtime: float):
+    """Read-only connection for one warehouse version; a dbt rebuild (new mtime) opens a fresh one.
+
+    DuckDB keeps one database instance per path in a process, so the previous connection (and the
+    panel cursors made from it) is closed first; otherwise connect() would hand back the old file.
+    """
+    held = _open_connections()
+    while held:
+        held.pop().close()
     if not os.path.exists(WAREHOUSE):
         raise FileNotFoundError(f"Warehouse not found: {WAREHOUSE}")
-    # read_only=False so temp objects work; file lives on external SSD mount
-    return duckdb.connect(WAREHOUSE, read_only=True)
-
-
-def resolve_schema(con, base_name: str, table_name: str) -> str | None:
-    for schema in (f"main_{base_name}", base_name):
-        try:
-            exists = con.execute(
-                "SELECT 1 FROM information_schema.tables "
-                "WHERE table_schema = ? AND table_name = ? LIMIT 1",
-                [schema, table_name]
-            ).fetchone()
-            if exists:
-                con.execute(f"SELECT 1 FROM {schema}.{table_name} LIMIT 1")
-                return schema
-        except Exception:
-            continue
-    return None
-
-
-def load_filters(con, silver_schema):
-    seasons = con.sql(
-        f"SELECT DISTINCT season FROM {silver_schema}.laps ORDER BY season"
-    ).df()["season"].tolist()
-    sessions = con.sql(
-        f"SELECT DISTINCT session_code FROM {silver_schema}.laps ORDER BY session_code"
-    ).df()["session_code"].tolist()
-    return seasons, sessions
+    # Pure read workload: read-only skips WAL/locking. File lives on external SSD mount, so cache
+    # Parquet/footer metadata and size the engine explicitly instead of relying on defaults.
+    con = duckdb.connect(WAREHOUSE, read_only=True, config={
+        "threads": DUCKDB_THREADS,
+        "memory_limit": DUCKDB_MEMORY_LIMIT,
+        "enable_object_cache": True,
+    })
+    held.append(con)
+    return con
 
 
-def ns_to_pretty_series(ns_series: pd.Series) -> pd.Series:
-    """int ns → 'mm:ss.mmm' (string). Leaves non-numeric as-is."""
-    s = pd.to_numeric(ns_series, errors="coerce")
-    td = pd.to_timedelta(s, unit="ns")
-    comp = td.dt.components
-    return comp.apply(lambda r: f"{int(r.minutes):02d}:{int(r.seconds):02d}.{int(r.milliseconds):03d}", axis=1)
+@st.cache_resource(show_spinner=False)
+def get_http():
+    # one keep-alive client per server process instead of a new TCP handshake per click
+    return httpx.Client(
+        base_url=AI_SERVICE_URL,
+        http2=True,
+        timeout=90.0,
+        limits=httpx.Limits(max_keepalive_connections=4, keepalive_expiry=60.0),
+    )
 
 
-def ns_to_seconds(ns_series: pd.Series) -> pd.Series:
-    s = pd.to_numeric(ns_series, errors="coerce")
-    return s / 1e9
+def query_arrow(con, sql: str, params: Optional[Dict] = None) -> pa.Table:
+    """Run one query on its own cursor so concurrent sessions don't serialize on the cached connection.
+
+    Results stay Arrow: st.dataframe renders them directly, and only the columns a chart plots get
+    converted to pandas.
+    """
+    with con.cursor() as cur:
+        return cur.sql(sql, params=params).fetch_arrow_table()
+
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def resolve_schema(base_name: str, table_name: str, mtime: float) -> str | None:
+    """First of main_<base>/<base> that holds table_name, found with one catalog query."""
+    candidates = [f"main_{base_name}", base_name]
+    with get_con(mtime).cursor() as cur:
+        found = {
+            row[0]
+            for row in cur.execute(
+                "SELECT table_schema FROM information_schema.tables "
+                "WHERE table_name = ? AND table_schema IN (?, ?)",
+                [table_name, *candidates],
+            ).fetchall()
+        }
+    return next((schema for schema in candidates if schema in found), None)
+
+
+def laps_source(silver_schema: str) -> str:
+    """FROM-clause relation for lap scans: silver laps, or the bronze Parquet partitions when enabled."""
+    if not LAPS_FROM_BRONZE:
+        return f"{silver_schema}.laps"
+    # same columns as the silver model; typed partition keys keep the filters prunable
+    glob = os.path.join(BRONZE, "laps", "**", "*.parquet")
+    return f"""(
+        SELECT season, round, grand_prix, session AS session_code,
+               * EXCLUDE (season, round, grand_prix, session)
+        FROM read_parquet('{glob}', hive_partitioning = true,
+             hive_types = {{'season': INTEGER, 'round': INTEGER, 'grand_prix': VARCHAR, 'session': VARCHAR}})
+    ) AS laps"""
+
+
+def warehouse_mtime() -> float:
+    # part of every cache key below: a dbt rebuild changes it and invalidates cached results
+    return os.path.getmtime(WAREHOUSE)
+
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def load_filters(silver_schema: str, mtime: float):
+    con = get_con(mtime)
+    seasons = query_arrow(
+        con, f"SELECT DISTINCT season FROM {laps_source(silver_schema)} ORDER BY season"
+    )["season"].to_pylist()
+    sessions = query_arrow(
+        con, f"SELECT DISTINCT session_code FROM {laps_source(silver_schema)} ORDER BY session_code"
+    )["session_code"].to_pylist()
+    return seasons, sessions
 
 
-def safe_to_datetime(x):
-    """Try several parses for date-like columns (string/date/timestamp)."""
+# Panel statements are PREPAREd once per cursor; $1 is the season, $2 the session code.
+def kpi_sql(silver_schema: str) -> str:
+    # Session date and KPIs share a single scan of the selected laps.
+    return f"""
+        WITH laps AS (
+          SELECT * FROM {laps_source(silver_schema)}
+          WHERE season = $1 AND session_code = $2
+        )
+        SELECT
+          MIN(CAST(lapstartdate AS TIMESTAMP)) AS session_date,
+          COUNT(*)::BIGINT AS total_laps,
+          COUNT(DISTINCT driver)::BIGINT AS unique_drivers,
+          COUNT(DISTINCT team)::BIGINT AS unique_teams
+        FROM laps
+    """
+
+
+def fastest_sql(gold_schema: str) -> str:
+    # Sorting, top-N and formatting (the ns_to_pretty macro dbt persists) happen in DuckDB;
+    # only the 50 rows shown come back.
+    return f"""
+        SELECT season, round, grand_prix, session_code, driver,
+               ns_to_pretty(best_lap_time) AS best_lap_pretty,
+               best_lap_time / 1e9 AS best_lap_seconds
+        FROM {gold_schema}.driver_session_summary
+        WHERE season = $1 AND session_code = $2
+        ORDER BY best_lap_time NULLS LAST
+        LIMIT 50
+    """
+
+
+def team_sql(gold_schema: str) -> str:
+    return f"""
+        SELECT season, round, grand_prix, session_code, team,
+               team_laps_on_track, team_pitstops,
+               ns_to_pretty(team_best_lap_time) AS team_best_lap_pretty
+        FROM {gold_schema}.team_event_summary
+        WHERE season = $1 AND session_code = $2
+        ORDER BY round, team
+    """
+
+
+def pace_sql(gold_schema: str) -> str:
+    # medians are precomputed by dbt (gold.session_pace); this is a lookup, not a silver aggregation
+    return f"""
+        SELECT lapnumber,
+               median_laptime / 1e9 AS median_laptime_seconds
+        FROM {gold_schema}.session_pace
+        WHERE season = $1 AND session_code = $2
+        ORDER BY lapnumber
+    """
+
+
+PANELS = ("kpi", "fastest", "team", "pace")
+
+
+@st.cache_resource(show_spinner=False, max_entries=1)
+def get_panel_cursors(silver_schema: str, gold_schema: str, mtime: float) -> "queue.Queue":
+    """Cursors with every panel statement PREPAREd, so a rerun only binds and executes.
+
+    Prepared statements live on the connection that prepared them, hence a small pool of
+    cursors instead of a fresh cursor per query.
+    """
+    statements = {
+        "kpi": kpi_sql(silver_schema),
+        "fastest": fastest_sql(gold_schema),
+        "team": team_sql(gold_schema),
+        "pace": pace_sql(gold_schema),
+    }
+    cursors: "queue.Queue" = queue.Queue()
+    for _ in range(DUCKDB_POOL_SIZE):
+        cur = get_con(mtime).cursor()
+        for name in PANELS:
+            cur.execute(f"PREPARE panel_{name} AS {statements[name]}")
+        cursors.put(cur)
+    return cursors
+
+
+def sql_literal(value) -> str:
+    """Render a filter value for EXECUTE, which (unlike SELECT) doesn't accept bound parameters."""
+    if value is None:
+        return "NULL"
+    if isinstance(value, numbers.Integral):
+        return str(int(value))
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def run_panel(cursors: "queue.Queue", name: str, season, session_code: str) -> pa.Table:
+    cur = cursors.get()
     try:
-        return pd.to_datetime(x)
-    except Exception:
-        # Last resort: numeric ns → ts
-        xn = pd.to_numeric(x, errors="coerce")
-        return pd.to_datetime(xn, unit="ns")
+        return cur.execute(
+            f"EXECUTE panel_{name}({sql_literal(season)}, {sql_literal(session_code)})"
+        ).fetch_arrow_table()
+    finally:
+        cursors.put(cur)
+
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def load_panels(silver_schema: str, gold_schema: str, season, session_code: str, mtime: float):
+    """kpi, fastest, team and pace Arrow tables for one (season, session); reruns with the same selection are cache hits."""
+    cursors = get_panel_cursors(silver_schema, gold_schema, mtime)
+    # Panel queries are independent: run them concurrently, each on its own cursor, so
+    # DuckDB executes them in parallel instead of one round-trip after another.
+    with ThreadPoolExecutor(max_workers=len(PANELS)) as executor:
+        futures = [executor.submit(run_panel, cursors, name, season, session_code) for name in PANELS]
+        return tuple(future.result() for future in futures)
 
 
 def call_ai_copilot(question: str, season: Optional[int], session_code: Optional[str]) -> Dict:
@@ -76,12 +237,11 @@ def call_ai_copilot(question: str, season: Optional[int], session_code: Optional
         payload["season"] = season
     if session_code:
         payload["session_code"] = session_code
-    url = f"{AI_SERVICE_URL}/ask"
     try:
-        resp = requests.post(url, json=payload, timeout=90)
+        resp = get_http().post("/ask", json=payload)
         resp.raise_for_status()
         return resp.json()
-    except requests.RequestException as exc:
+    except httpx.HTTPError as exc:
         raise RuntimeError(f"AI service unreachable: {exc}") from exc
 
 
@@ -107,13 +267,14 @@ st.caption(f"Warehouse: {WAREHOUSE}")
 
 # Connect + resolve schemas
 try:
-    con = get_con()
+    mtime = warehouse_mtime()
+    con = get_con(mtime)
 except Exception as e:
     st.error(f"Could not open DuckDB at {WAREHOUSE}: {e}")
     st.stop()
 
-silver = resolve_schema(con, "silver", "laps")
-gold   = resolve_schema(con, "gold",   "driver_session_summary")
+silver = resolve_schema("silver", "laps", mtime)
+gold   = resolve_schema("gold",   "driver_session_summary", mtime)
 
 if not silver or not gold:
     st.error(f"Could not resolve schemas. Found silver={silver}, gold={gold}. Run dbt build first.")
@@ -122,104 +283,66 @@ if not silver or not gold:
 # Sidebar filters
 with st.sidebar:
     st.subheader("Filters")
-    seasons, sessions = load_filters(con, silver)
+    seasons, sessions = load_filters(silver, mtime)
     season = st.selectbox("Season", seasons, index=len(seasons)-1 if seasons else 0)
     session_code = st.selectbox("Session", sessions, index=sessions.index("R") if "R" in sessions else 0)
 
+try:
+    kpi, fastest, team, pace = load_panels(silver, gold, season, session_code, mtime)
+except duckdb.CatalogException as e:
+    # warehouse predates gold.session_pace / the ns_to_pretty macro
+    st.error(f"Warehouse is missing objects the dashboard needs ({e}). Run dbt build first.")
+    st.stop()
+
+kpi_row = kpi.to_pylist()[0] if kpi.num_rows else {}
+
 # Session date (formatted)
-date_df = con.sql(
-    f"""
-    SELECT MIN(lapstartdate) AS session_date
-    FROM {silver}.laps
-    WHERE season = $season AND session_code = $session
-    """,
-    params={"season": season, "session": session_code}
-).df()
-if len(date_df) and pd.notna(date_df.loc[0, "session_date"]):
-    session_date = safe_to_datetime(date_df.loc[0, "session_date"])
-    st.caption(f"Session date: {session_date.strftime('%Y-%m-%d')}")
+# session_date arrives as a TIMESTAMP (datetime), so no client-side parsing is needed
+if kpi_row.get("session_date") is not None:
+    st.caption(f"Session date: {kpi_row['session_date'].strftime('%Y-%m-%d')}")
 else:
     st.caption("Session date: N/A")
 
 # KPIs
-kpi = con.sql(
-    f"""
-    WITH laps AS (
-      SELECT * FROM {silver}.laps
-      WHERE season = $season AND session_code = $session
-    )
-    SELECT
-      COUNT(*)::BIGINT AS total_laps,
-      COUNT(DISTINCT driver)::BIGINT AS unique_drivers,
-      COUNT(DISTINCT team)::BIGINT AS unique_teams
-    FROM laps
-    """,
-    params={"season": season, "session": session_code}
-).df()
-
 col1, col2, col3 = st.columns(3)
-col1.metric("Total Laps", f"{int(kpi['total_laps'][0]):,}")
-col2.metric("Drivers", f"{int(kpi['unique_drivers'][0]):,}")
-col3.metric("Teams", f"{int(kpi['unique_teams'][0]):,}")
+col1.metric("Total Laps", f"{int(kpi_row.get('total_laps') or 0):,}")
+col2.metric("Drivers", f"{int(kpi_row.get('unique_drivers') or 0):,}")
+col3.metric("Teams", f"{int(kpi_row.get('unique_teams') or 0):,}")
 
 st.markdown("---")
 left, right = st.columns(2)
 
 # ---------- Fastest laps (Gold) ----------
-fastest = con.sql(
-    f"""
-    SELECT season, round, grand_prix, session_code, driver, best_lap_time
-    FROM {gold}.driver_session_summary
-    WHERE season = $season AND session_code = $session
-    """,
-    params={"season": season, "session": session_code}
-).df()
-
-if len(fastest):
-    fastest["best_lap_pretty"]  = ns_to_pretty_series(fastest["best_lap_time"])
-    fastest["best_lap_seconds"] = ns_to_seconds(fastest["best_lap_time"])
-
+if fastest.num_rows:
     # Table (clean columns)
-    tbl = fastest[["season","round","grand_prix","session_code","driver","best_lap_pretty"]]\
-          .sort_values(["best_lap_pretty"])
+    tbl = fastest.select(["season","round","grand_prix","session_code","driver","best_lap_pretty"])
     left.subheader("Fastest laps (top 50)")
-    left.dataframe(tbl.head(50), use_container_width=True)
+    left.dataframe(tbl, use_container_width=True)
 
-    # Chart: Top-20 fastest
-    top20 = fastest.sort_values("best_lap_seconds").head(20)
+    # Chart: Top-20 fastest (rows are already ordered by lap time)
+    top20 = fastest.select(["driver","best_lap_seconds"]).slice(0, 20).to_pandas()
     fig_fast = px.bar(top20, x="driver", y="best_lap_seconds", title="Top-20 fastest laps (seconds)")
     left.plotly_chart(fig_fast, use_container_width=True, theme="streamlit")
 else:
     left.info("No fastest-lap data for this selection.")
 
 # ---------- Team event summary (Gold) ----------
-team = con.sql(
-    f"""
-    SELECT season, round, grand_prix, session_code, team,
-           team_laps_on_track, team_pitstops, team_best_lap_time
-    FROM {gold}.team_event_summary
-    WHERE season = $season AND session_code = $session
-    ORDER BY round, team
-    """,
-    params={"season": season, "session": session_code}
-).df()
-
-if len(team):
-    team["team_best_lap_pretty"]  = ns_to_pretty_series(team["team_best_lap_time"])
-    team["team_best_lap_seconds"] = ns_to_seconds(team["team_best_lap_time"])
-
+if team.num_rows:
     right.subheader("Team event summary")
     right.dataframe(
-        team[["season","round","grand_prix","session_code","team",
-              "team_laps_on_track","team_pitstops","team_best_lap_pretty"]],
+        team.select(["season","round","grand_prix","session_code","team",
+                     "team_laps_on_track","team_pitstops","team_best_lap_pretty"]),
         use_container_width=True
     )
 
-    # Chart: grouped bars (laps vs pitstops)
+    # Chart: grouped bars (laps vs pitstops); rows already arrive ordered, so hand Plotly that
+    # order instead of letting it re-sort the categories
+    team_chart = team.select(["team","team_laps_on_track","team_pitstops"]).to_pandas()
     fig_team = px.bar(
-        team.sort_values(["round","team"]),
+        team_chart,
         x="team", y=["team_laps_on_track","team_pitstops"],
-        barmode="group", title="Team laps vs pitstops"
+        barmode="group", title="Team laps vs pitstops",
+        category_orders={"team": team_chart["team"].unique().tolist()},
     )
     right.plotly_chart(fig_team, use_container_width=True, theme="streamlit")
 else:
@@ -227,24 +350,18 @@ else:
 
 st.markdown("---")
 
-# ---------- Pace evolution (Silver) ----------
-pace = con.sql(
-    f"""
-    SELECT lapnumber,
-           /* median() works for numeric ns */
-           median(laptime) AS median_laptime
-    FROM {silver}.laps
-    WHERE season = $season AND session_code = $session AND laptime IS NOT NULL
-    GROUP BY lapnumber
-    ORDER BY lapnumber
-    """,
-    params={"season": season, "session": session_code}
-).df()
-
-if len(pace):
-    pace["median_laptime_seconds"] = ns_to_seconds(pace["median_laptime"])
-    fig_pace = px.line(pace, x="lapnumber", y="median_laptime_seconds",
-                       title="Session pace over laps (median lap time, seconds)")
+# ---------- Pace evolution (Gold) ----------
+if pace.num_rows:
+    # WebGL trace fed straight from the Arrow columns, thinned to a bounded number of points
+    step = max(1, pace.num_rows // PACE_MAX_POINTS)
+    pace_points = pace.take(pa.array(range(0, pace.num_rows, step))) if step > 1 else pace
+    fig_pace = go.Figure(go.Scattergl(
+        x=pace_points["lapnumber"].to_numpy(),
+        y=pace_points["median_laptime_seconds"].to_numpy(),
+        mode="lines",
+    ))
+    fig_pace.update_layout(title="Session pace over laps (median lap time, seconds)",
+                           xaxis_title="lapnumber", yaxis_title="median_laptime_seconds")
     st.plotly_chart(fig_pace, use_container_width=True, theme="streamlit")
 else:
     st.info("No pace data available for this selection.")
@@ -271,7 +388,7 @@ if AI_SERVICE_URL:
 
                 rows = ai_result.get("rows", [])
                 if rows:
-                    df_ai = pd.DataFrame(rows)
+                    df_ai = pd.DataFrame(rows, columns=ai_result.get("columns"))
                     st.dataframe(df_ai, use_container_width=True)
                     render_ai_chart(df_ai, ai_result.get("chart", {}))
                 else:
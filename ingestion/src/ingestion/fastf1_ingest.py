@@ -1,5 +1,8 @@
 from __future__ import annotations
 import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
 from loguru import logger
 import pandas as pd
 from slugify import slugify
@@ -12,37 +15,105 @@ from ingestion.utils import (
 
 SESSION_CODES = ["FP1", "FP2", "FP3", "Q", "S", "R"]  # Sprint (S) + Race (R)
 
-def partition_dir(root: str, table: str, season: int, round_no: int, gp_slug: str, code: str) -> str:
-    return os.path.join(
-        root, table,
-        f"season={season}",
-        f"round={round_no:02d}",
-        f"grand_prix={gp_slug}",
-        f"session={code}"
-    )
-
-def to_pandas_safe(obj) -> pd.DataFrame | None:
-    if obj is None:
-        return None
-    if isinstance(obj, pd.DataFrame):
-        return obj
-    # Some fastf1 objects can be converted like this:
+def session_partition(season: int, round_no: int, gp_slug: str, code: str) -> dict[str, str]:
+    # Hive partition keys, outermost first; string values keep round zero-padded (round=01)
+    return {"season": str(season), "round": f"{round_no:02d}", "grand_prix": gp_slug, "session": code}
+
+def partition_dir(root: str, table: str, partition: dict[str, str]) -> str:
+    return os.path.join(root, table, *(f"{k}={v}" for k, v in partition.items()))
+
+def _init_worker(cache_dir: str) -> None:
+    # each worker process needs its own handle on the on-disk FastF1 cache
+    fastf1.Cache.enable_cache(cache_dir)
+
+def ingest_session(task: tuple[int, int, str, str], bronze_root: str) -> None:
+    """Load one (season, round, grand prix, session) and write its bronze partitions."""
+    season, round_no, gp_slug, code = task
+    partition = session_partition(season, round_no, gp_slug, code)
+    # one sentinel per session: a finished session skips the load and all three table checks
+    sentinel = os.path.join(partition_dir(bronze_root, "_ingested", partition), "_SUCCESS")
+    if os.path.exists(sentinel):
+        logger.info(f"session already ingested, skip → {sentinel}")
+        return
     try:
-        if hasattr(obj, "to_frame"):
-            df = obj.to_frame(index=False)
-            if isinstance(df, pd.DataFrame):
-                return df
-    except Exception:
-        pass
+        sess = fastf1.get_session(season, round_no, code)
+    except ValueError as e:
+        # FastF1 raises ValueError for a session the event doesn't have (e.g. no sprint)
+        logger.debug(f"No data for {season} R{round_no:02d} {code}: {e}")
+        return
+    except Exception as e:
+        logger.warning(f"Failed to get {season} R{round_no:02d} {code}: {e}")
+        return
     try:
-        return pd.DataFrame(obj)
-    except Exception:
-        return None
+        sess.load(laps=True, telemetry=False, weather=True)
+    except Exception as e:
+        # rate limits, cache locks, network errors: not written, so the next run retries it
+        logger.warning(f"Failed to load {season} R{round_no:02d} {code}: {e}")
+        return
+    ok = True
+    # laps are the session's core table; without them it was not really ingested yet
+    has_laps = False
+
+    # LAPS
+    try:
+        laps = getattr(sess, "laps", None)
+        if laps is not None and not laps.empty:
+            laps = snake_columns(laps)
+            out = partition_dir(bronze_root, "laps", partition)
+            if dir_has_parquet(out):
+                logger.info(f"laps exists, skip → {out}")
+            else:
+                write_parquet(laps, os.path.join(bronze_root, "laps"), partition, sort_by=["driver", "lapnumber"])
+                logger.info(f"wrote laps → {out}")
+            has_laps = True
+    except Exception as e:
+        ok = False
+        logger.warning(f"laps write failed: {e}")
+
+    # WEATHER
+    try:
+        weather = getattr(sess, "weather_data", None)
+        if weather is not None and not weather.empty:
+            weather = snake_columns(weather)
+            out = partition_dir(bronze_root, "weather", partition)
+            if dir_has_parquet(out):
+                logger.info(f"weather exists, skip → {out}")
+            else:
+                write_parquet(weather, os.path.join(bronze_root, "weather"), partition, sort_by=["time"])
+                logger.info(f"wrote weather → {out}")
+    except Exception as e:
+        ok = False
+        logger.warning(f"weather write failed: {e}")
+
+    # RESULTS
+    try:
+        # SessionResults subclasses DataFrame; anything else is converted once, errors surface below
+        results = getattr(sess, "results", None)
+        if results is not None and not isinstance(results, pd.DataFrame):
+            results = pd.DataFrame(results)
+        if results is not None and not results.empty:
+            results = snake_columns(results)
+            out = partition_dir(bronze_root, "results", partition)
+            if dir_has_parquet(out):
+                logger.info(f"results exists, skip → {out}")
+            else:
+                write_parquet(results, os.path.join(bronze_root, "results"), partition)
+                logger.info(f"wrote results → {out}")
+    except Exception as e:
+        ok = False
+        logger.warning(f"results write failed: {e}")
+
+    # an unpublished session loads with empty tables; leave it unmarked so a later run picks it up
+    if ok and has_laps:
+        os.makedirs(os.path.dirname(sentinel), exist_ok=True)
+        Path(sentinel).touch()
 
 def main():
     cache_dir = os.getenv("F1_CACHE_DIR", "/opt/data/cache")
     bronze_root = os.getenv("F1_BRONZE", "/opt/data/bronze")
     seasons = season_list_from_env("F1_SEASONS")
+    # workers share one FastF1 cache and one API rate limit, so keep the default small
+    workers = int(os.getenv("F1_INGEST_WORKERS", str(min(4, os.cpu_count() or 1))))
 
     logger.info(f"Cache: {cache_dir}")
     logger.info(f"Bronze root: {bronze_root}")
@@ -50,6 +121,9 @@ def main():
 
     fastf1.Cache.enable_cache(cache_dir)
 
+    # Schedules are cheap; collect every (season, round, gp, session) first so the
+    # expensive sess.load() calls can be spread over worker processes.
+    tasks: list[tuple[int, int, str, str]] = []
     for season in seasons:
         logger.info(f"=== Season {season} ===")
         try:
@@ -58,72 +132,28 @@ def main():
             logger.error(f"Failed to get schedule for {season}: {e}")
             continue
 
-        # schedule rows have 'RoundNumber' and 'EventName'
-        for _, ev in schedule.iterrows():
-            try:
-                round_no = int(ev["RoundNumber"])
-                gp_name = str(ev["EventName"])
-            except Exception:
-                # schedule formats can vary across versions
-                try:
-                    round_no = int(ev.get("RoundNumber") or ev.get("Round", 0))
-                    gp_name = str(ev.get("EventName") or ev.get("Event", "unknown"))
-                except Exception:
-                    logger.warning(f"Skipping schedule row due to missing fields: {ev}")
-                    continue
+        # schedule columns are 'RoundNumber'/'EventName' (older releases: 'Round'/'Event');
+        # read them as whole columns instead of building a Series per row
+        round_col = "RoundNumber" if "RoundNumber" in schedule.columns else "Round"
+        name_col = "EventName" if "EventName" in schedule.columns else "Event"
+        if round_col not in schedule.columns:
+            logger.error(f"Schedule for {season} has no round column: {list(schedule.columns)}")
+            continue
+        rounds = pd.to_numeric(schedule[round_col], errors="coerce")
+        names = schedule[name_col].astype(str) if name_col in schedule.columns else pd.Series("unknown", index=schedule.index)
+        valid = rounds.notna().to_numpy()
+        if not valid.all():
+            logger.warning(f"Skipping {int((~valid).sum())} schedule row(s) without a round number")
 
+        for round_no, gp_name in zip(rounds[valid].astype(int).tolist(), names[valid].tolist()):
             gp_slug = slugify(gp_name or f"round-{round_no}")
             logger.info(f"Round {round_no:02d} – {gp_name} ({gp_slug})")
+            tasks.extend((season, round_no, gp_slug, code) for code in SESSION_CODES)
 
-            for code in SESSION_CODES:
-                try:
-                    sess = fastf1.get_session(season, round_no, code)
-                    sess.load(laps=True, telemetry=False, weather=True)
-                except Exception as e:
-                    logger.debug(f"No data for {season} R{round_no:02d} {code}: {e}")
-                    continue
-
-                # LAPS
-                try:
-                    laps = getattr(sess, "laps", None)
-                    if laps is not None and not laps.empty:
-                        laps = snake_columns(laps)
-                        out = partition_dir(bronze_root, "laps", season, round_no, gp_slug, code)
-                        if dir_has_parquet(out):
-                            logger.info(f"laps exists, skip → {out}")
-                        else:
-                            write_parquet(laps, out)
-                            logger.info(f"wrote laps → {out}")
-                except Exception as e:
-                    logger.warning(f"laps write failed: {e}")
-
-                # WEATHER
-                try:
-                    weather = getattr(sess, "weather_data", None)
-                    if weather is not None and not weather.empty:
-                        weather = snake_columns(weather)
-                        out = partition_dir(bronze_root, "weather", season, round_no, gp_slug, code)
-                        if dir_has_parquet(out):
-                            logger.info(f"weather exists, skip → {out}")
-                        else:
-                            write_parquet(weather, out)
-                            logger.info(f"wrote weather → {out}")
-                except Exception as e:
-                    logger.warning(f"weather write failed: {e}")
-
-                # RESULTS
-                try:
-                    results = to_pandas_safe(getattr(sess, "results", None))
-                    if results is not None and not results.empty:
-                        results = snake_columns(results)
-                        out = partition_dir(bronze_root, "results", season, round_no, gp_slug, code)
-                        if dir_has_parquet(out):
-                            logger.info(f"results exists, skip → {out}")
-                        else:
-                            write_parquet(results, out)
-                            logger.info(f"wrote results → {out}")
-                except Exception as e:
-                    logger.warning(f"results write failed: {e}")
+    logger.info(f"Loading {len(tasks)} sessions with {workers} worker(s)")
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(cache_dir,)) as executor:
+        for _ in executor.map(partial(ingest_session, bronze_root=bronze_root), tasks, chunksize=4):
+            pass
 
     logger.info("✅ Bronze ingestion finished")
 
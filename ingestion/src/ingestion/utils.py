@@ -1,5 +1,8 @@
 import os, re
+from functools import lru_cache
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
 
 def get_env(name: str, default: str | None = None) -> str:
     val = os.getenv(name, default)
@@ -19,26 +22,74 @@ def season_list_from_env(var: str = "F1_SEASONS") -> list[int]:
     return out
 
 _slug_re = re.compile(r"[^a-z0-9]+")
+@lru_cache(maxsize=1024)
 def _to_snake(s: str) -> str:
-    s = s.strip().lower()
-    s = _slug_re.sub("_", s)
-    s = s.strip("_")
-    return s
+    # the same few dozen FastF1 column names recur for every session, so memoize them
+    return _slug_re.sub("_", s.strip().lower()).strip("_")
 
 def snake_columns(df: pd.DataFrame) -> pd.DataFrame:
-    df = df.copy()
+    # shallow copy: new column labels without duplicating the underlying data
+    df = df.copy(deep=False)
     df.columns = [_to_snake(str(c)) for c in df.columns]
     return df
 
-def ensure_dir(path: str) -> None:
-    os.makedirs(path, exist_ok=True)
-
 def dir_has_parquet(path: str) -> bool:
-    return os.path.isdir(path) and any(f.endswith(".parquet") for f in os.listdir(path))
+    # scandir is lazy, so this stops at the first part file instead of listing the whole directory
+    if not os.path.isdir(path):
+        return False
+    with os.scandir(path) as entries:
+        return any(e.name.endswith(".parquet") for e in entries)
+
+# Low-cardinality strings the dashboard filters/groups on; dictionary pages keep them small and
+# make equality filters cheap. Other columns are written plain.
+_DICT_COLUMNS = ("driver", "team", "compound", "session_code")
+
+# rows converted from pandas per Arrow batch; the dataset writer regroups them into row groups
+_BATCH_ROWS = 64_000
+_ROW_GROUP_ROWS = 128_000
 
-def write_parquet(df: pd.DataFrame, out_dir: str, filename_prefix: str = "part") -> None:
-    ensure_dir(out_dir)
-    out_path = os.path.join(out_dir, f"{filename_prefix}-00000.parquet")
+def write_parquet(df: pd.DataFrame, table_root: str, partition: dict[str, str],
+                  sort_by: list[str] | None = None) -> None:
+    """Write ``df`` as one Hive partition of the dataset at ``table_root``.
+
+    ``partition`` maps partition column → value, outermost first (season=…/round=…/…); pyarrow's
+    dataset writer lays out the directories and drops those columns from the file itself. The
+    frame is streamed in record batches, so the full Arrow copy never sits next to it in memory.
+    """
     if len(df) == 0:
         return
-    df.to_parquet(out_path, engine="pyarrow", index=False)
+    # sorted row groups give tight min/max statistics for readers to skip on
+    keys = [c for c in (sort_by or []) if c in df.columns]
+    if keys:
+        df = df.sort_values(keys, kind="stable")
+    data_schema = pa.Schema.from_pandas(df, preserve_index=False)
+    schema = data_schema
+    for name in partition:
+        schema = schema.append(pa.field(name, pa.string()))
+
+    def batches():
+        for start in range(0, len(df), _BATCH_ROWS):
+            batch = pa.RecordBatch.from_pandas(
+                df.iloc[start:start + _BATCH_ROWS], schema=data_schema, preserve_index=False
+            )
+            part_cols = [pa.repeat(pa.scalar(value, pa.string()), batch.num_rows) for value in partition.values()]
+            yield pa.RecordBatch.from_arrays(batch.columns + part_cols, schema=schema)
+
+    fmt = ds.ParquetFileFormat()
+    ds.write_dataset(
+        batches(), table_root,
+        schema=schema,
+        format=fmt,
+        file_options=fmt.make_write_options(
+            compression="zstd", compression_level=3,
+            use_dictionary=[c for c in _DICT_COLUMNS if c in schema.names],
+            write_statistics=True,
+            data_page_version="2.0",
+        ),
+        partitioning=ds.partitioning(pa.schema([schema.field(name) for name in partition]), flavor="hive"),
+        basename_template="part-{i}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+        min_rows_per_group=_ROW_GROUP_ROWS,
+        max_rows_per_group=_ROW_GROUP_ROWS,
+        use_threads=False,  # one small partition per call; keeps the sort order intact
+    )
@@ -0,0 +1,12 @@
+-- macros/ns_to_pretty.sql — persisted DuckDB macro: numeric ns → 'mm:ss.mmm'
+-- Created in the warehouse on every run so read-only consumers (dashboard, AI service) can
+-- format lap times in-engine without rebuilding the string expression in each query.
+
+-- ns is cast to BIGINT first: on a DOUBLE (e.g. PERCENTILE_CONT output) `//` yields '1.0' and
+-- lpad would truncate it to '1.'.
+{% macro create_ns_to_pretty() -%}
+CREATE OR REPLACE MACRO main.ns_to_pretty(ns) AS
+  lpad((CAST(ns AS BIGINT) // 60000000000)::VARCHAR, 2, '0') || ':' ||
+  lpad((CAST(ns AS BIGINT) // 1000000000 % 60)::VARCHAR, 2, '0') || '.' ||
+  lpad((CAST(ns AS BIGINT) // 1000000 % 1000)::VARCHAR, 3, '0')
+{%- endmacro %}
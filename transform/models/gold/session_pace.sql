@@ -0,0 +1,15 @@
+-- median lap time per lap number for a (season, session_code); the dashboard pace chart
+-- reads this instead of re-aggregating silver laps on every selection change
+WITH laps AS (
+  SELECT * FROM {{ ref('laps') }}
+  WHERE laptime IS NOT NULL
+),
+pace_agg AS (
+  SELECT
+    season, session_code, lapnumber,
+    PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY laptime) AS median_laptime
+  FROM laps
+  GROUP BY 1,2,3
+)
+SELECT * FROM pace_agg
+ORDER BY season, session_code, lapnumber
@@ -0,0 +1,15 @@
+WITH laps AS (
+  SELECT * FROM {{ ref('laps') }}
+),
+session_agg AS (
+  SELECT
+    season, round, grand_prix, session_code,
+    MIN(lapstartdate)      AS session_date,
+    COUNT(*)               AS total_laps,
+    COUNT(DISTINCT driver) AS unique_drivers,
+    COUNT(DISTINCT team)   AS unique_teams
+  FROM laps
+  GROUP BY 1,2,3,4
+)
+SELECT * FROM session_agg
+ORDER BY season, session_code, round
@@ -8,3 +8,5 @@ select
   cast(session    as varchar) as session_code,
   * exclude (season, round, grand_prix, session)
 from src
+-- physical order matches the dashboard filters so row-group min/max stats prune scans
+order by season, session_code, lapstartdate